@@ -1,14 +1,116 @@
-from fastapi import FastAPI, Query
+from fastapi import FastAPI, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
-from pydantic import BaseModel
-from typing import Optional, List
-from urllib.parse import quote
+from fastapi.responses import StreamingResponse, ORJSONResponse, RedirectResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, List, Dict
+from urllib.parse import quote, urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener
+import asyncio
+import logging
+import queue
+import re
+import threading
+import time
 import yt_dlp
-import requests
+import httpx
+import orjson
+import redis.asyncio as aioredis
 import os
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Request handlers only enqueue log records; a listener thread does the
+# blocking write to stderr so error bursts don't stall the event loop
+LOG_QUEUE = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(
+    logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+)
+LOG_LISTENER = QueueListener(LOG_QUEUE, _log_handler)
+
+log = logging.getLogger("fastapi_backend")
+log.setLevel(logging.INFO)
+log.addHandler(QueueHandler(LOG_QUEUE))
+log.propagate = False
+
+
+# Started per worker: a thread started at import would not survive the fork
+# under `gunicorn --preload`
+@app.on_event("startup")
+async def start_log_listener():
+    LOG_LISTENER.start()
+
+# Bounded pool for blocking yt-dlp calls
+EXECUTOR = ThreadPoolExecutor(max_workers=16)
+
+# Proxy chunk size, tunable per deployment (default 1 MiB)
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 1024 * 1024))
+
+# Shared keep-alive pool for CDN streaming
+HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=25,
+    limits=httpx.Limits(
+        max_keepalive_connections=100,
+        max_connections=200,
+        keepalive_expiry=75,
+    ),
+)
+
+# Extraction cache; CDN URLs are signed, so keep TTL well under their lifetime
+REDIS = aioredis.from_url(
+    os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+    socket_connect_timeout=0.3,
+    socket_timeout=0.3,
+)
+CACHE_TTL = int(os.getenv("CACHE_TTL", 1800))
+
+# After a Redis failure, skip the cache for a while instead of paying a
+# timeout on every request
+CACHE_RETRY_AFTER = 30
+_cache_down_until = 0.0
+
+# In-flight extractions, so concurrent requests for one URL share a single run
+INFLIGHT: Dict[str, asyncio.Future] = {}
+
+
+# Best-effort pre-connect at boot. Only helps proxied downloads from these
+# exact hosts within keepalive_expiry; regional CDN hosts aren't covered.
+CDN_WARM_HOSTS = ("scontent.cdninstagram.com", "video.cdninstagram.com")
+
+
+# Strong refs to fire-and-forget tasks so they aren't garbage collected
+BACKGROUND_TASKS = set()
+
+
+async def _warm(url: str):
+    try:
+        await HTTP.head(url, timeout=5)
+    except Exception:
+        pass
+
+
+def _warm_in_background(url: str):
+    task = asyncio.create_task(_warm(url))
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+
+@app.on_event("startup")
+async def warm_cdn_connections():
+    # Don't hold up readiness on egress or slow DNS
+    for h in CDN_WARM_HOSTS:
+        _warm_in_background(f"https://{h}/")
+
+
+@app.on_event("shutdown")
+async def close_clients():
+    await HTTP.aclose()
+    await REDIS.aclose()
+    await asyncio.to_thread(_close_ydls)
+    LOG_LISTENER.stop()
 
 # CORS for frontend
 app.add_middleware(
@@ -22,8 +124,11 @@ app.add_middleware(
 # Models
 # ----------------------------
 
+MAX_URL_LENGTH = 2048
+
+
 class InfoRequest(BaseModel):
-    url: str
+    url: str = Field(..., max_length=MAX_URL_LENGTH)
 
 class VideoItem(BaseModel):
     index: int
@@ -32,6 +137,8 @@ class VideoItem(BaseModel):
     download_url: str
 
 class InfoResponse(BaseModel):
+    model_config = ConfigDict(ser_json_bytes="utf8")
+
     ok: bool
     message: Optional[str] = None
     items: List[VideoItem] = []
@@ -42,10 +149,16 @@ class InfoResponse(BaseModel):
 # Utils
 # ----------------------------
 
+# Precomputed labels for 0-10 min, which covers nearly every Reel
+_DURATIONS = tuple(f"{s // 60}:{s % 60:02d}" for s in range(601))
+
+
 def _format_duration(seconds: Optional[int]) -> str:
     if seconds is None:
         return ""
     seconds = int(seconds)
+    if 0 <= seconds < len(_DURATIONS):
+        return _DURATIONS[seconds]
     m, s = divmod(seconds, 60)
     return f"{m}:{s:02d}"
 
@@ -54,14 +167,23 @@ def _format_duration(seconds: Optional[int]) -> str:
 # Shared yt-dlp options
 # ----------------------------
 
+COOKIE_PATH = os.path.join(os.getcwd(), "cookies.txt")
+
+
 def get_ydl_opts():
-    cookie_path = os.path.join(os.getcwd(), "cookies.txt")
+    cookie_path = COOKIE_PATH
 
     return {
         "quiet": True,
         "nocheckcertificate": True,
         "extract_flat": False,
         "cookiefile": cookie_path,   # THE FIX!!!
+        # Skip probes we never need for a single direct-URL lookup
+        "skip_download": True,
+        "noplaylist": False,         # carousels come back as playlists
+        "check_formats": False,
+        "format": "best[protocol^=http]/best",
+        "socket_timeout": 10,
         "http_headers": {
             "User-Agent": (
                 "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
@@ -73,90 +195,328 @@ def get_ydl_opts():
     }
 
 
-# ----------------------------
-# API: /api/info
-# ----------------------------
+# One YoutubeDL per executor thread: construction is expensive, but an
+# instance is not safe to share across concurrent extract_info calls.
+_ydl_local = threading.local()
+_ydl_instances: List[yt_dlp.YoutubeDL] = []
+_ydl_instances_lock = threading.Lock()
 
-@app.post("/api/info", response_model=InfoResponse)
-def get_info(payload: InfoRequest):
-    url = payload.url.strip()
 
+def _cookie_mtime() -> float:
     try:
-        ydl_opts = get_ydl_opts()
+        return os.path.getmtime(COOKIE_PATH)
+    except OSError:
+        return 0.0
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
 
-        items: List[VideoItem] = []
+def _get_ydl() -> yt_dlp.YoutubeDL:
+    ydl = getattr(_ydl_local, "ydl", None)
+    mtime = _cookie_mtime()
 
-        def build(entry, idx):
-            title = entry.get("title") or f"Clip {idx+1}"
-            return VideoItem(
-                index=idx,
-                title=title,
-                duration=_format_duration(entry.get("duration")),
-                download_url=f"/api/download?url={quote(url, safe='')}&index={idx}"
-            )
+    if ydl is None:
+        ydl = _ydl_local.ydl = yt_dlp.YoutubeDL(get_ydl_opts())
+        with _ydl_instances_lock:
+            _ydl_instances.append(ydl)
+    elif mtime != _ydl_local.cookie_mtime and mtime:
+        # cookies.txt was rotated on disk; load() merges, so drop stale ones
+        ydl.cookiejar.clear()
+        ydl.cookiejar.load()
+
+    _ydl_local.cookie_mtime = mtime
+    return ydl
+
+
+def _close_ydls():
+    # Let running extractions finish, then close() each instance, which also
+    # writes refreshed cookies back to cookies.txt
+    EXECUTOR.shutdown(wait=True)
+    with _ydl_instances_lock:
+        for ydl in _ydl_instances:
+            ydl.close()
+        _ydl_instances.clear()
+
+
+def _extract_info_sync(url: str) -> dict:
+    return _get_ydl().extract_info(url, download=False)
+
+
+async def _extract_info(url: str) -> dict:
+    # yt-dlp does blocking network I/O; keep it off the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(EXECUTOR, _extract_info_sync, url)
+
+
+# Media hosts /api/download will redirect to or proxy from (SSRF guard)
+DIRECT_HOST_SUFFIXES = (".cdninstagram.com", ".fbcdn.net")
+
+# Direct media links on those hosts need no extraction
+_DIRECT = re.compile(r"^https?://[^/]+/.+\.(mp4|m4v|mov)(\?|$)", re.I)
+
+
+def _is_allowed_media_host(url: str) -> bool:
+    host = (urlsplit(url).hostname or "").lower()
+    return host.endswith(DIRECT_HOST_SUFFIXES)
+
+
+def _direct_entries(url: str) -> Optional[dict]:
+    if not _DIRECT.match(url) or not _is_allowed_media_host(url):
+        return None
+    return {"entries": [{"url": url, "title": "video", "duration": None}]}
+
+
+def _cache_key(url: str) -> str:
+    return "ig:" + url.strip().split("#", 1)[0]
 
-        if "entries" in info and info["entries"]:
-            for i, e in enumerate(info["entries"]):
-                items.append(build(e, i))
-        else:
-            items.append(build(info, 0))
 
-        return InfoResponse(ok=True, items=items, input_url=url)
+def _cache_available() -> bool:
+    return time.monotonic() >= _cache_down_until
 
+
+def _cache_failed(e: Exception):
+    global _cache_down_until
+    _cache_down_until = time.monotonic() + CACHE_RETRY_AFTER
+    log.warning("cache unavailable, bypassing for %ss: %r", CACHE_RETRY_AFTER, e)
+
+
+async def _cache_get(key: str) -> Optional[bytes]:
+    if not _cache_available():
+        return None
+    try:
+        return await REDIS.get(key)
+    except Exception as e:
+        _cache_failed(e)
+        return None
+
+
+async def _cache_set(key: str, value: bytes):
+    if not _cache_available():
+        return
+    try:
+        await REDIS.setex(key, CACHE_TTL, value)
     except Exception as e:
-        print("INFO ERROR:", e)
-        return InfoResponse(
-            ok=False,
-            message="Invalid or unsupported URL",
-            input_url=url
+        _cache_failed(e)
+
+
+async def _extract_entries(url: str, key: str) -> dict:
+    info = await _extract_info(url)
+    entries = info["entries"] if info.get("entries") else [info]
+
+    # Merged formats only set requested_formats; there is nothing single to
+    # redirect or proxy to, and such a result must never be cached.
+    # yt-dlp's generic extractor resolves any media link, so also refuse
+    # hosts we won't redirect to or fetch from.
+    for i, e in enumerate(entries):
+        if not e.get("url"):
+            raise ValueError(f"No direct media URL for entry {i}")
+        if not _is_allowed_media_host(e["url"]):
+            raise ValueError(f"Unsupported media host for entry {i}")
+
+    result = {
+        "entries": [
+            {
+                "url": e.get("url"),
+                "title": e.get("title"),
+                "duration": e.get("duration"),
+            }
+            for e in entries
+        ]
+    }
+
+    await _cache_set(key, orjson.dumps(result))
+    return result
+
+
+async def _resolve(url: str) -> dict:
+    """Return {"entries": [{url, title, duration}]}, cached in Redis."""
+    direct = _direct_entries(url)
+    if direct is not None:
+        return direct
+
+    key = _cache_key(url)
+
+    cached = await _cache_get(key)
+    if cached:
+        return orjson.loads(cached)
+
+    # No await between lookup and insert, so this is atomic on the event loop
+    fut = INFLIGHT.get(key)
+    if fut is not None:
+        # shield: a disconnecting waiter must not cancel everyone else's result
+        try:
+            return await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            if not fut.cancelled():
+                raise  # this waiter itself was cancelled
+            # The leader was cancelled; its entry is gone, so retry (this
+            # waiter may become the new leader)
+            return await _resolve(url)
+
+    fut = asyncio.get_running_loop().create_future()
+    INFLIGHT[key] = fut
+    try:
+        result = await _extract_entries(url, key)
+        fut.set_result(result)
+        return result
+    except Exception as e:
+        fut.set_exception(e)
+        fut.exception()  # mark retrieved when nobody else was waiting
+        raise
+    finally:
+        if not fut.done():
+            fut.cancel()
+        del INFLIGHT[key]
+
+
+CDN_MAX_REDIRECTS = 5
+
+
+async def _open_cdn_stream(direct_url: str) -> httpx.Response:
+    """GET direct_url, following redirects only to allowed media hosts."""
+    req = HTTP.build_request(
+        "GET",
+        direct_url,
+        headers={
+            "User-Agent": "Mozilla/5.0",
+            "Referer": "https://www.instagram.com/",
+            # We forward raw bytes without decoding, so they must be the
+            # file itself rather than a compressed transfer
+            "Accept-Encoding": "identity"
+        }
+    )
+
+    for _ in range(CDN_MAX_REDIRECTS + 1):
+        resp = await HTTP.send(req, stream=True)
+        if not resp.is_redirect:
+            return resp
+
+        # Follow by hand so every hop goes through the host allow-list
+        next_req = resp.next_request
+        await resp.aclose()
+        if next_req is None or not _is_allowed_media_host(str(next_req.url)):
+            raise Exception("CDN redirected to an unsupported host")
+        req = next_req
+
+    raise Exception("CDN error: too many redirects")
+
+
+# ----------------------------
+# API: /api/info
+# ----------------------------
+
+# Request and response are handled as plain dicts; InfoRequest/InfoResponse
+# only document the shape in OpenAPI, which skips Pydantic model
+# construction and validation on the hot path.
+@app.post(
+    "/api/info",
+    responses={200: {"model": InfoResponse}},
+    openapi_extra={
+        "requestBody": {
+            "required": True,
+            "content": {
+                "application/json": {"schema": InfoRequest.model_json_schema()}
+            },
+        }
+    },
+)
+async def get_info(request: Request):
+    try:
+        body = orjson.loads(await request.body())
+        url = body.get("url") if isinstance(body, dict) else None
+    except orjson.JSONDecodeError:
+        url = None
+
+    if not isinstance(url, str) or not url.strip() or len(url) > MAX_URL_LENGTH:
+        return ORJSONResponse(
+            status_code=422,
+            content={"ok": False, "message": "Request body must include a valid url"}
+        )
+
+    url = url.strip()
+
+    try:
+        info = await _resolve(url)
+
+        qurl = quote(url, safe='')
+        items = [
+            {
+                "index": i,
+                "title": e.get("title") or f"Clip {i+1}",
+                "duration": _format_duration(e.get("duration")),
+                "download_url": f"/api/download?url={qurl}&index={i}"
+            }
+            for i, e in enumerate(info["entries"])
+        ]
+
+        return ORJSONResponse(
+            {"ok": True, "message": None, "items": items, "input_url": url}
         )
 
+    except Exception:
+        log.exception("info error")
+        return ORJSONResponse({
+            "ok": False,
+            "message": "Invalid or unsupported URL",
+            "items": [],
+            "input_url": url
+        })
+
 
 # ----------------------------
 # API: /api/download
 # ----------------------------
 
 @app.get("/api/download")
-def download(url: str = Query(...), index: int = Query(0)):
+async def download(
+    url: str = Query(...),
+    index: int = Query(0),
+    proxy: bool = Query(False),
+):
     try:
-        ydl_opts = get_ydl_opts()
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
+        info = await _resolve(url)
 
-        entry = info["entries"][index] if "entries" in info else info
+        entry = info["entries"][index]
         direct_url = entry["url"]
 
         filename = (entry.get("title") or "instagram_video").replace(" ", "_") + ".mp4"
 
-        cdn_stream = requests.get(
-            direct_url,
-            stream=True,
-            timeout=25,
-            headers={
-                "User-Agent": "Mozilla/5.0",
-                "Referer": "https://www.instagram.com/"
-            }
-        )
+        # Let the client fetch straight from the CDN unless it asked us to
+        # proxy (e.g. the CDN blocks the client's IP)
+        if not proxy:
+            return RedirectResponse(
+                direct_url,
+                status_code=302,
+                headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+            )
+
+        cdn_stream = await _open_cdn_stream(direct_url)
 
         if cdn_stream.status_code != 200:
+            await cdn_stream.aclose()
             raise Exception(f"CDN error: {cdn_stream.status_code}")
 
+        headers = {
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "Cache-Control": "no-cache",
+            # Behind nginx (proxy_buffering off; proxy_request_buffering off;)
+            # this streams straight through instead of spooling to disk
+            "X-Accel-Buffering": "no"
+        }
+        # Raw identity bytes, so the CDN's length is exact; lets clients
+        # show progress and avoids chunked transfer encoding
+        content_length = cdn_stream.headers.get("Content-Length")
+        if content_length:
+            headers["Content-Length"] = content_length
+
         return StreamingResponse(
-            cdn_stream.iter_content(chunk_size=1024 * 64),
+            cdn_stream.aiter_raw(chunk_size=STREAM_CHUNK_SIZE),
             media_type="video/mp4",
-            headers={
-                "Content-Disposition": f'attachment; filename="{filename}"',
-                "Cache-Control": "no-cache"
-            }
+            headers=headers,
+            background=BackgroundTask(cdn_stream.aclose)
         )
 
     except Exception as e:
-        print("DOWNLOAD ERROR:", e)
-        return JSONResponse(
+        log.exception("download error")
+        return ORJSONResponse(
             status_code=400,
             content={"ok": False, "message": "Download failed", "error": str(e)}
         )
@@ -169,3 +529,21 @@ def download(url: str = Query(...), index: int = Query(0)):
 @app.get("/api/health")
 def health():
     return {"ok": True, "status": "running"}
+
+
+# ----------------------------
+# Entrypoint
+# ----------------------------
+
+if __name__ == "__main__":
+    import uvicorn
+
+    # uvicorn[standard] ships both; pin them rather than relying on "auto"
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.getenv("PORT", 8000)),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+    )